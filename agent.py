@@ -1,44 +1,229 @@
+import asyncio
+import hashlib
 import os
-import json
-from openai import OpenAI
-import pytz
-import uuid
+import httpx
+import msgspec
+import numpy as np
+import openai
+import orjson
+import re
+import secrets
+import time
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from zoneinfo import ZoneInfo
+
+PACIFIC_TZ = ZoneInfo("US/Pacific")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Below this cosine similarity the local vector search is considered a miss
+# and recommendation falls back to the router's tag matching
+RECOMMEND_SIM_THRESHOLD = 0.25
+RECOMMEND_TOP_K = 3
+# Cap on candidates sent to the product-selection prompt — every extra
+# product line costs ~30 input tokens
+RECOMMEND_MAX_CANDIDATES = 20
+
+# Circuit breaker: after this many API failures inside the window, skip the
+# API and return the fallback immediately instead of stacking retry latency
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_WINDOW_SECONDS = 30
+
+# Patterns for pulling order credentials out of the user's message
+# (order numbers look like "#W001" in CustomerOrders.json)
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+ORDER_NUMBER_RE = re.compile(r"#?(W\d{3,})", re.IGNORECASE)
+
+# History sizing: the message list grows append-only up to MAX, then the
+# oldest block is cut in one shot, keeping the newest KEEP. Between cuts
+# each request's messages are exactly the previous request's plus one, so
+# the provider's prompt-prefix cache stays hot instead of being invalidated
+# every turn by a sliding window.
+HISTORY_MAX_MESSAGES = 40
+HISTORY_KEEP_MESSAGES = 20
+
+# Structured output schema for the fused intent + tag router call
+ROUTER_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "sierra_router",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "intents": {
+                    "type": "array",
+                    "items": {
+                        "type": "string",
+                        "enum": ["order", "recommendation", "early_riser", "general"],
+                    },
+                },
+                "tags": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                },
+            },
+            "required": ["intents", "tags"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+class Product(msgspec.Struct):
+    """Catalog record decoded straight from ProductCatalog.json.
+
+    Fixed-layout slots make the tag-index build and summary formatting
+    attribute lookups instead of per-access dict hashing.
+    """
+    ProductName: str
+    SKU: str
+    Inventory: int
+    Description: str
+    Tags: list[str]
+    # "Name — Description" line for the selection prompt, filled in at load
+    summary: str = ""
+
+
+class Order(msgspec.Struct):
+    """Customer order record decoded straight from CustomerOrders.json."""
+    CustomerName: str
+    Email: str
+    OrderNumber: str
+    ProductsOrdered: list[str]
+    Status: str
+    # null in CustomerOrders.json until a shipment has a tracking number
+    TrackingNumber: str | None
+
+
+class SemanticCache:
+    """
+    Embedding-based nearest-neighbor cache for free-form user text.
+    Paraphrases ("where is my package?" vs "track my order") miss an
+    exact-match cache but land within the similarity threshold here,
+    letting us reuse a stored answer and skip the GPT call entirely.
+    """
+
+    def __init__(self, client: AsyncOpenAI, model: str = EMBEDDING_MODEL, threshold: float = 0.92):
+        self.client = client
+        self.model = model
+        self.threshold = threshold
+        # Row-per-entry matrix of L2-normalized embeddings + parallel values
+        self._matrix: np.ndarray | None = None
+        self._values: list[str] = []
+
+    async def lookup(self, text: str) -> tuple[str | None, np.ndarray | None]:
+        """
+        Returns (cached value or None, query embedding). The embedding is
+        returned so a subsequent store() doesn't re-embed the same text.
+        """
+        try:
+            response = await self.client.embeddings.create(model=self.model, input=text)
+        except Exception as e:
+            print(f"[Embedding error] {e}")
+            return None, None
+
+        query = np.asarray(response.data[0].embedding, dtype=np.float32)
+        query /= np.linalg.norm(query)
+
+        if self._matrix is not None:
+            sims = self._matrix @ query
+            best = int(np.argmax(sims))
+            if sims[best] > self.threshold:
+                return self._values[best], query
+
+        return None, query
+
+    def store(self, embedding: np.ndarray | None, value: str) -> None:
+        if embedding is None:
+            return
+        row = embedding[None, :]
+        self._matrix = row if self._matrix is None else np.vstack([self._matrix, row])
+        self._values.append(value)
+
 
 class SierraAgent:
     def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        # One HTTP/2 client for the agent's lifetime: concurrent GPT calls
+        # multiplex over a single TLS connection instead of paying TCP/TLS
+        # setup per request
+        self._http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=30,
+        )
+        self.client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=self._http_client)
         self.model = "gpt-4o"
+        # Short structured outputs (intent labels + tags) don't need the big
+        # model — the mini tier is an order of magnitude cheaper and faster
+        self.classifier_model = "gpt-4o-mini"
         self.system_prompt = (
             "You are Sierra, an adventurous and cheerful outdoor gear expert. "
             "Use friendly, trail-inspired language, emojis like 🏕️🌲⛰️, and stay helpful and CONCISE. 3 sentence limit for all responses. "
             "If a question is unrelated to Sierra Outfitters, still answer politely but stay in character."
         )
 
-        with open("data/CustomerOrders.json") as f:
-            self.orders = json.load(f)
-        with open("data/ProductCatalog.json") as f:
-            self.products = json.load(f)
+        with open("data/CustomerOrders.json", "rb") as f:
+            self.orders = msgspec.json.decode(f.read(), type=list[Order])
+        with open("data/ProductCatalog.json", "rb") as f:
+            self.products = msgspec.json.decode(f.read(), type=list[Product])
 
-        # Running conversation history containing (user_input -> gpt_responses)
-        self.history = []
-        # Tag dictionary mapping (lowercase tag -> list of relevant products)
+        # O(1) order lookups keyed on normalized (email, order number)
+        self._order_index = {
+            (o.Email.strip().lower(), o.OrderNumber.strip()): o
+            for o in self.orders
+        }
+
+        # Persistent messages list handed to the API as-is: system prompt at
+        # index 0, then conversation turns. Appending in place avoids
+        # rebuilding and copying the list every call; truncation is deferred
+        # per HISTORY_MAX_MESSAGES / HISTORY_KEEP_MESSAGES above.
+        self._messages: list[dict] = [{"role": "system", "content": self.system_prompt}]
+        # Explicit prompt-cache breakpoints for backends that need them
+        # (Anthropic/Bedrock, or routed through LiteLLM). OpenAI's prefix
+        # cache is automatic, so this stays off by default.
+        self.use_cache_control = False
+        # Tag dictionary mapping (lowercase tag -> list of product indices —
+        # ints are smaller than object references and de-dup cheaply as sets)
         self.tag_index = defaultdict(list)
 
-        for product in self.products:
-            for tag in product["Tags"]:
+        for index, product in enumerate(self.products):
+            # Summary line sent to GPT is static per product — format once here
+            product.summary = f"{product.ProductName} — {product.Description}"
+            for tag in product.Tags:
                 normalized_tag = tag.lower()
-                self.tag_index[normalized_tag].append(product)
-    
-    def handle(self, user_input: str) -> str:
+                self.tag_index[normalized_tag].append(index)
+
+        # tag_index and products never change after construction, so the
+        # tag list/CSV sent to GPT can be built once instead of per request
+        self._tag_list = sorted(self.tag_index.keys())
+        self._tag_csv = ", ".join(self._tag_list)
+        self._valid_tag_set = set(self.tag_index.keys())
+
+        # Cap concurrent in-flight OpenAI requests once handlers fan out
+        self._gpt_semaphore = asyncio.Semaphore(10)
+        # Rolling window of recent API failure timestamps for the breaker
+        self._api_failures: deque[float] = deque()
+        # Exact-match response cache for deterministic call_gpt prompts
+        # (keyed on model + temperature + prompt, so repeated classifier and
+        # tag-selection prompts skip the API entirely)
+        self._resp_cache: dict[bytes, str] = {}
+        # Semantic cache catches paraphrased user text the exact-match cache misses
+        self._route_cache = SemanticCache(self.client)
+        # Catalog embedding matrix for local vector recommendation; built
+        # lazily by the first recommendation request (one batched API call)
+        self._prod_emb: np.ndarray | None = None
+        self._prod_emb_lock = asyncio.Lock()
+
+    async def _route(self, user_input: str) -> tuple[list[str], list[str]]:
         """
-        Routes the user input to the correct functionality
-        (order tracking, product recommendation, promo, or general GPT reply).
+        Classifies user_input into intents and candidate product tags with a
+        single structured GPT call (semantic-cached across paraphrases).
         """
-        # Question type router
-        intent_prompt = (
+        router_prompt = (
             "Classify the user's message into one or more of the following intent categories:\n\n"
             "- order: The user is asking about the status of a specific order they have already placed. "
             "This includes questions about tracking, shipping, delivery dates, or order numbers.\n"
@@ -47,81 +232,193 @@ class SierraAgent:
             "- early_riser: The user is asking for a discount, promotional code, or any deal. "
             "This includes general questions about promotions or requests for discounts.\n"
             "- general: The message doesn’t fit the above — e.g. general conversation, brand questions, greetings, etc.\n\n"
-            f"User message: '{user_input}'\n\n"
-            "Respond with a comma-separated list of one or more intents from the list above. "
-            "Use only the exact labels: order, recommendation, early_riser, general."
+            f"Available product tags are: {self._tag_csv}.\n"
+            "If the message asks for gear, also choose up to 8 relevant tags from that list; "
+            "otherwise return an empty tags list.\n\n"
+            f"User message: '{user_input}'"
         )
-        intent_response = self.call_gpt(intent_prompt)
+        route_response, query_emb = await self._route_cache.lookup(user_input)
+        cache_hit = route_response is not None
+        if not cache_hit:
+            # max_tokens bounds the JSON payload (≤4 labels + ≤8 short tags)
+            # so a runaway completion can't blow up tail latency
+            route_response = await self.call_gpt(
+                router_prompt,
+                model=self.classifier_model,
+                max_tokens=120,
+                response_format=ROUTER_RESPONSE_FORMAT,
+            )
+
+        try:
+            route = orjson.loads(route_response)
+        except orjson.JSONDecodeError:
+            # call_gpt's failure fallback isn't JSON — don't cache it, or this
+            # utterance (and every paraphrase) stays broken past the outage
+            return ["general"], []
+
+        if not cache_hit:
+            self._route_cache.store(query_emb, route_response)
+        return route.get("intents") or ["general"], route.get("tags") or []
 
-        intents = [intent.strip() for intent in intent_response.split(",") if intent.strip()]
+    async def handle(self, user_input: str, stream: bool = True, history: list[dict] | None = None) -> str:
+        """
+        Routes the user input to the correct functionality
+        (order tracking, product recommendation, promo, or general GPT reply).
+        With stream=True the final reply is printed to stdout token-by-token
+        as it generates; the full text is returned either way. history
+        substitutes an isolated conversation for the agent's shared one
+        (used by handle_batch so concurrent turns can't interleave).
+        """
+        # Question type router: one structured call classifies intents AND
+        # picks candidate product tags, instead of two serial GPT round-trips
+        intents, tags = await self._route(user_input)
 
-        responses = []
+        # Triggered handlers are independent of each other, so overlap their
+        # GPT round-trips instead of paying each one's latency in sequence.
+        coros = []
         if "order" in intents:
-            responses.append(self.handle_order_info(user_input))
+            coros.append(self.handle_order_info(user_input))
         if "recommendation" in intents:
-            responses.append(self.handle_product_recommendation(user_input))
+            coros.append(self.handle_product_recommendation(user_input, tags))
         if "early_riser" in intents:
-            responses.append(self.handle_early_riser_promo())
+            coros.append(self.handle_early_riser_promo())
+        responses = list(await asyncio.gather(*coros))
         if not responses or "general" in intents:
-            return self.call_gpt_and_update_history(user_input)
-        
+            return await self.call_gpt_and_update_history(user_input, stream=stream, history=history)
+
         additional_info = "\n".join(responses)
         compiled_prompt = (
             f"User question: {user_input}. "
             f"Use the following information to best answer the user's question: {additional_info}"
         )
-        
-        return self.call_gpt_and_update_history(compiled_prompt)
 
-    def handle_order_info(self, query) -> str:
+        return await self.call_gpt_and_update_history(compiled_prompt, stream=stream, history=history)
+
+    async def handle_batch(self, inputs: list[str]) -> list[str]:
+        """
+        Runs handle over many inputs concurrently — for offline evaluation
+        and regression scripts rather than the interactive chat loop.
+        Streaming is off so concurrent replies don't interleave on stdout,
+        and each input gets its own conversation so concurrent turns can't
+        leak into the shared history or each other's API payloads.
+        """
+        return list(await asyncio.gather(*(
+            self.handle(text, stream=False, history=[{"role": "system", "content": self.system_prompt}])
+            for text in inputs
+        )))
+
+    async def call_gpt_batch(self, prompts: list[str], temperature: float = 0) -> list[str]:
         """
-        Prompts the user for their email + order number,
+        Fans call_gpt out over many prompts at once; the shared semaphore
+        keeps the number of in-flight API requests capped.
+        """
+        return list(await asyncio.gather(*(self.call_gpt(p, temperature) for p in prompts)))
+
+    async def warm_caches(self) -> None:
+        """
+        Pre-populates the route cache with one synthetic query per catalog
+        product, so early recommendation requests land on warm entries.
+        """
+        synthetic = [
+            f"Any recommendations for something like the {p.ProductName}?"
+            for p in self.products
+        ]
+        await asyncio.gather(*(self._route(q) for q in synthetic))
+
+    async def handle_order_info(self, query) -> str:
+        """
+        Pulls the email + order number out of the user's message,
         finds the matching order info, and uses GPT to return a natural reply.
         """
-        email = input("Please provide your email: ")
-        order_number = input("Please provide your order number: ")
+        email_match = EMAIL_RE.search(query)
+        number_match = ORDER_NUMBER_RE.search(query)
+        if not email_match or not number_match:
+            return (
+                "Order Status: The customer's email and/or order number is missing. "
+                "Ask the user to include both in their message (e.g. 'jane@example.com, order #W001')."
+            )
 
-        match = next(
-            (o for o in self.orders if o["Email"] == email and o["OrderNumber"] == order_number),
-            None
-        )
+        email = email_match.group()
+        order_number = "#" + number_match.group(1).upper()
+        match = self._order_index.get((email.strip().lower(), order_number))
 
         if match:
-            status = match["Status"]
-            tracking = match["TrackingNumber"]
-            base = (
-                f"Order {order_number} is {status}. "
-                f"Tracking link: https://tools.usps.com/go/TrackConfirmAction?tLabels={tracking}"
-            )
+            base = f"Order {order_number} is {match.Status}."
+            if match.TrackingNumber:
+                base += (
+                    f" Tracking link: "
+                    f"https://tools.usps.com/go/TrackConfirmAction?tLabels={match.TrackingNumber}"
+                )
         else:
             base = "Couldn't find an order with that email and order number."
 
         return base
 
-    def handle_product_recommendation(self, query: str) -> str:
+    async def _ensure_catalog_embeddings(self) -> bool:
         """
-        Matches user query to product tags or names dynamically using GPT.
+        Batch-embeds the whole catalog in one API call the first time a
+        recommendation needs it. Returns False if embeddings are unavailable.
         """
-        tag_list = sorted(self.tag_index.keys())
-        tag_csv = ", ".join(tag_list)
+        if self._prod_emb is not None:
+            return True
+        async with self._prod_emb_lock:
+            if self._prod_emb is not None:
+                return True
+            texts = [
+                f"{p.ProductName}. {p.Description}. Tags: {', '.join(p.Tags)}"
+                for p in self.products
+            ]
+            try:
+                response = await self.client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+            except Exception as e:
+                print(f"[Embedding error] {e}")
+                return False
+            matrix = np.asarray([d.embedding for d in response.data], dtype=np.float32)
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+            self._prod_emb = matrix
+            return True
 
-        # dynamically generate most relevant tags from existing tag set
-        tag_selection_prompt = (
-            f"You are an assistant helping customers find gear.\n"
-            f"Available product tags are: {tag_csv}.\n"
-            f"User said: '{query}'\n"
-            f"Choose up to 8 relevant tags from the list based on the user's request."
-            f"Respond with only the chosen tags, as a comma-separated list."
-        )
-        tag_response = self.call_gpt(tag_selection_prompt)
+    async def _match_products_by_embedding(self, query: str) -> list[Product] | None:
+        """
+        Local vector search: embeds the query and takes the top-K catalog
+        products by cosine similarity. Returns None when embeddings are
+        unavailable or nothing clears the similarity threshold.
+        """
+        if not await self._ensure_catalog_embeddings():
+            return None
+        try:
+            response = await self.client.embeddings.create(model=EMBEDDING_MODEL, input=query)
+        except Exception as e:
+            print(f"[Embedding error] {e}")
+            return None
+
+        q = np.asarray(response.data[0].embedding, dtype=np.float32)
+        q /= np.linalg.norm(q)
+        sims = self._prod_emb @ q
+        if float(sims.max()) < RECOMMEND_SIM_THRESHOLD:
+            return None
+        top = np.argsort(sims)[::-1][:RECOMMEND_TOP_K]
+        return [self.products[i] for i in top]
 
-        extracted_tags = [tag.strip() for tag in tag_response.split(",")]
-        valid_tags = [tag for tag in extracted_tags if tag in self.tag_index]
+    def _match_products_by_tags(self, tags: list[str]) -> list[Product]:
+        """Tag-based candidate gathering (fallback when vector search misses)."""
+        valid_tags = [tag for tag in (t.strip().lower() for t in tags) if tag in self._valid_tag_set]
 
-        # gather set of possible recommendations
-        matched_products = []
+        # gather set of possible recommendations, de-duping products that
+        # match under several tags (duplicate lines waste prompt tokens)
+        idx_set = set()
         for tag in valid_tags:
-            matched_products.extend(self.tag_index[tag])
+            idx_set.update(self.tag_index[tag])
+        return [self.products[i] for i in sorted(idx_set)[:RECOMMEND_MAX_CANDIDATES]]
+
+    async def handle_product_recommendation(self, query: str, tags: list[str]) -> str:
+        """
+        Finds candidate products with a local embedding search (falling back
+        to the router's tags) and narrows them to a single pick using GPT.
+        """
+        matched_products = await self._match_products_by_embedding(query)
+        if matched_products is None:
+            matched_products = self._match_products_by_tags(tags)
 
         fallback = (
             "Product Status: Couldn't find anything that matches. Ask the user to describe what they're looking for in a bit more detail."
@@ -129,8 +426,8 @@ class SierraAgent:
         if not matched_products:
             return fallback
 
-        # narrow set down to a single option 
-        summary_text = "\n".join(f"{p['ProductName']} — {p['Description']}" for p in matched_products)
+        # narrow set down to a single option
+        summary_text = "\n".join(p.summary for p in matched_products)
         product_selection_prompt = (
             f"You are an assistant helping customers find gear.\n"
             f"User said: '{query}'\n"
@@ -140,59 +437,177 @@ class SierraAgent:
             f"Recommended Purchase for Customer: Product Name - Product Description\n"
             f"If nothing relevant is available, return the following text: {fallback}"
         )
-        product_selection_response = self.call_gpt(product_selection_prompt)
-        
+        product_selection_response = await self.call_gpt(product_selection_prompt)
+
         return product_selection_response
 
 
-    def handle_early_riser_promo(self) -> str:
+    async def handle_early_riser_promo(self) -> str:
         """
         Checks current time (Pacific Time). If within 8–10 AM, generates a discount code.
         """
-        now = datetime.now(pytz.timezone("US/Pacific"))
+        now = datetime.now(PACIFIC_TZ)
         if 8 <= now.hour < 10:
-            code = "SIERRA-" + str(uuid.uuid4())[:4].upper()
+            code = "SIERRA-" + secrets.token_hex(2).upper()
             base = f"This user qualifies for the Early Riser promotion! They may use discount code {code} for 10% off."
         else:
             base = "The Early Riser promotion only runs from 8–10 AM Pacific Time. This user does not currently qualify."
 
         return base
 
-    def call_gpt(self, prompt: str, temperature: float = 0) -> str:
+    def _circuit_open(self) -> bool:
+        """
+        True when recent failures exceed the threshold — callers should fall
+        back immediately rather than piling retry latency onto a down API.
+        """
+        now = time.monotonic()
+        while self._api_failures and now - self._api_failures[0] > CIRCUIT_WINDOW_SECONDS:
+            self._api_failures.popleft()
+        return len(self._api_failures) >= CIRCUIT_FAILURE_THRESHOLD
+
+    def _record_failure(self) -> None:
+        self._api_failures.append(time.monotonic())
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_random_exponential(min=1, max=10),
+        retry=retry_if_exception_type(
+            (openai.RateLimitError, openai.APIConnectionError, openai.APIStatusError)
+        ),
+        reraise=True,
+    )
+    async def _create_completion(self, **kwargs):
+        """
+        chat.completions.create with exponential-backoff retries on
+        transient 429/connection/5xx errors, under the shared semaphore.
+        """
+        async with self._gpt_semaphore:
+            return await self.client.chat.completions.create(**kwargs)
+
+    async def call_gpt(
+        self,
+        prompt: str,
+        temperature: float = 0,
+        model: str | None = None,
+        max_tokens: int | None = None,
+        response_format: dict | None = None,
+    ) -> str:
+        model = model or self.model
+        # The key covers every parameter that shapes the reply — the same
+        # prompt with and without a JSON schema must not share an entry
+        fmt = orjson.dumps(response_format).decode() if response_format else ""
+        key = hashlib.blake2b(
+            f"{model}|{temperature}|{max_tokens}|{fmt}|{prompt}".encode(), digest_size=16
+        ).digest()
+        cached = self._resp_cache.get(key)
+        if cached is not None:
+            return cached
+
+        fallback = "Oops! Looks like I'm having trouble reaching the trailhead 🥾. Try again in a moment?"
+        if self._circuit_open():
+            return fallback
+
+        extra = {"response_format": response_format} if response_format else {}
+        if max_tokens is not None:
+            extra["max_tokens"] = max_tokens
         try:
-            return self.client.chat.completions.create(
-                model=self.model,
+            response = await self._create_completion(
+                model=model,
                 messages=[{"role": "user", "content": prompt}],
-                temperature=temperature
-            ).choices[0].message.content.strip()
+                temperature=temperature,
+                **extra
+            )
+            reply = response.choices[0].message.content.strip()
+            self._resp_cache[key] = reply
+            return reply
         except Exception as e:
             print(f"[GPT error] {e}")
-            return "Oops! Looks like I'm having trouble reaching the trailhead 🥾. Try again in a moment?"
+            self._record_failure()
+            return fallback
+
+    @staticmethod
+    def _mark(msg: dict) -> dict:
+        """
+        Returns a copy of msg with its content wrapped in a block carrying a
+        cache_control breakpoint (Anthropic/Bedrock-style explicit caching).
+        """
+        return {
+            "role": msg["role"],
+            "content": [{
+                "type": "text",
+                "text": msg["content"],
+                "cache_control": {"type": "ephemeral"},
+            }],
+        }
 
-    def call_gpt_and_update_history(self, new_user_message: str) -> str:
+    async def call_gpt_and_update_history(
+        self, new_user_message: str, stream: bool = True, history: list[dict] | None = None
+    ) -> str:
         """
         Sends conversation to GPT:
         - Includes system prompt
         - Includes user/assistant history
         - Adds new_user_message as the latest user content
+        With stream=True, tokens are printed to stdout as they arrive so the
+        user sees the reply start immediately instead of waiting for the
+        whole completion; the full text is returned either way. history
+        substitutes an isolated conversation (system prompt at index 0) for
+        the agent's shared self._messages.
         """
-        messages = [{"role": "system", "content": self.system_prompt}] + \
-                   self.history + \
-                   [{"role": "user", "content": new_user_message}]
+        conversation = history if history is not None else self._messages
+
+        fallback = "Something went off trail 🌲— please try again shortly!"
+        if self._circuit_open():
+            if stream:
+                print(fallback, end="", flush=True)
+            return fallback
+
+        conversation.append({"role": "user", "content": new_user_message})
+
+        messages = conversation
+        if self.use_cache_control:
+            # Two breakpoints: the static system block, and the history
+            # prefix up to the previous assistant turn. Marked on a shallow
+            # copy so the breakpoints don't accumulate in the persistent list.
+            messages = list(conversation)
+            messages[0] = self._mark(messages[0])
+            if len(messages) > 2:
+                messages[-2] = self._mark(messages[-2])
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.7
-            )
-            reply = response.choices[0].message.content.strip()
+            if stream:
+                chunks = []
+                response = await self._create_completion(
+                    model=self.model,
+                    messages=messages,
+                    temperature=0.7,
+                    stream=True
+                )
+                async for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+                        print(chunks[-1], end="", flush=True)
+                reply = "".join(chunks).strip()
+            else:
+                response = await self._create_completion(
+                    model=self.model,
+                    messages=messages,
+                    temperature=0.7
+                )
+                reply = response.choices[0].message.content.strip()
         except Exception as e:
             print(f"[GPT error] {e}")
-            return "Something went off trail 🌲— please try again shortly!"
+            self._record_failure()
+            # Drop the failed user turn so history only records real exchanges
+            conversation.pop()
+            if stream:
+                print(fallback, end="", flush=True)
+            return fallback
 
-        # Save actual conversation turns
-        self.history.append({"role": "user", "content": new_user_message})
-        self.history.append({"role": "assistant", "content": reply})
+        # Save the assistant turn; the user turn is already in place
+        conversation.append({"role": "assistant", "content": reply})
+        if len(conversation) - 1 > HISTORY_MAX_MESSAGES:
+            # cut the oldest block in one shot, preserving system at index 0
+            del conversation[1:1 + HISTORY_MAX_MESSAGES - HISTORY_KEEP_MESSAGES]
 
         return reply
@@ -1,17 +1,34 @@
+import asyncio
+
 from dotenv import load_dotenv
 from agent import SierraAgent
 
-load_dotenv()
-agent = SierraAgent()
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+
+async def main():
+    load_dotenv()
+    agent = SierraAgent()
+
+    print("🌲 Welcome to the Sierra Assistant! Ask me anything. (Type 'exit' to quit)\n")
+
+    # Chat loop
+    while True:
+        user_input = input("🧗 You: ")
 
-print("🌲 Welcome to the Sierra Assistant! Ask me anything. (Type 'exit' to quit)\n")
+        if user_input.strip().lower() in {"exit", "quit"}:
+            print("🏕️ Sierra Agent: Until next time — stay wild out there!")
+            break
 
-# Chat loop
-while True:
-    user_input = input("🧗 You: ")
+        # handle() streams the reply to stdout as it generates
+        print("🏔️ Sierra Agent: ", end="", flush=True)
+        await agent.handle(user_input)
+        print()
 
-    if user_input.strip().lower() in {"exit", "quit"}:
-        print("🏕️ Sierra Agent: Until next time — stay wild out there!")
-        break
 
-    print("🏔️ Sierra Agent:", agent.handle(user_input))
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())